@@ -20,6 +20,7 @@ import time
 from colors import colors  # noqa (ansicolors)
 from flask import Flask, request, g
 from .controller import api
+from .writer import parse_tile_formats, DEFAULT_TILE_FORMATS
 
 from .__version__ import (
     __author__, __copyright__, __description__, __email__,
@@ -30,6 +31,9 @@ from .__version__ import (
 def create_app():
     app = Flask(__name__)
     app.config.from_envvar('CONFIG_FILE')
+    app.config['TILE_FORMATS'] = parse_tile_formats(
+        app.config.get('TILE_FORMATS', ",".join(DEFAULT_TILE_FORMATS))
+    )
     app.logger.setLevel(logging.INFO)
 
     @app.before_request
@@ -26,10 +26,11 @@ from cytomine.models import UploadedFile, AbstractImage, AbstractSliceCollection
 from shapely import wkt
 from shapely.geometry import Point
 
-from .writer import create_hdf5
+from .writer import create_hdf5, create_hdf5_sharded
 from .reader import prepare_geometry, prepare_slices, get_mask, extract_profile, \
     get_cartesian_indexes, \
-    get_projection, get_bounds
+    get_projection, get_bounds, get_mean_spectrum, get_similarity_map, \
+    SIMILARITY_METRICS, subsample_mask, extract_points, get_bin_starts, bin_profile, BIN_METHODS
 from .utils import NumpyEncoder, CompanionFile, convert_axis
 from flask import abort, request, send_file, g, Blueprint, current_app
 
@@ -56,6 +57,10 @@ def make_hdf5():
     uploaded_file_id = _get_parameter()('uploadedFile')
     image_id = _get_parameter()('image')
     companion_file_id = _get_parameter()('companionFile')
+    shard_size = _get_parameter()(
+        'shardSize', current_app.config.get('SHARD_SIZE', 0), type=int
+    )
+    reconvert = _get_parameter()('reconvert', 'false', type=str).lower() == 'true'
 
     get_core_connection()
     uploaded_file = UploadedFile().fetch(uploaded_file_id)
@@ -67,13 +72,29 @@ def make_hdf5():
     tile_size = current_app.config['TILE_SIZE']
     n_written_tiles_to_update = current_app.config['N_WRITTEN_TILES_TO_UPDATE_PROGRESS']
     root = current_app.config['ROOT']
-    thread = Thread(
-        target=create_hdf5,
-        args=(
-            uploaded_file, image, slices, cf, n_workers, tile_size,
-            n_written_tiles_to_update, root
+    formats = current_app.config['TILE_FORMATS']
+    if shard_size > 0:
+        # Other HMS instances join the conversion when they receive the
+        # same request, as long as they share ROOT. A finished conversion
+        # is only started again when `reconvert` is given.
+        lease_duration = current_app.config.get('SHARD_LEASE_DURATION', 600)
+        thread = Thread(
+            target=create_hdf5_sharded,
+            args=(
+                uploaded_file, image, slices, cf, n_workers, tile_size,
+                n_written_tiles_to_update, root, shard_size, lease_duration,
+                formats
+            ),
+            kwargs=dict(reconvert=reconvert)
+        )
+    else:
+        thread = Thread(
+            target=create_hdf5,
+            args=(
+                uploaded_file, image, slices, cf, n_workers, tile_size,
+                n_written_tiles_to_update, root, formats
+            )
         )
-    )
     thread.daemon = True
     thread.start()
 
@@ -90,14 +111,35 @@ def get_profile():
     min_slice = _get_parameter()('minSlice', None, type=int)
     max_slice = _get_parameter()('maxSlice', None, type=int)
 
+    stride = _get_parameter()('stride', 1, type=int)
+    max_points = _get_parameter()('maxPoints', None, type=int)
+    bin_size = _get_parameter()('binSize', None, type=int)
+    bins = _get_parameter()('bins', None, type=int)
+    bin_method = _get_parameter()('binMethod', 'mean', type=str)
+    if stride < 1 or (max_points is not None and max_points < 1) \
+            or (bin_size is not None and bin_size < 1) \
+            or (bins is not None and bins < 1) or bin_method not in BIN_METHODS \
+            or (bin_size is not None and bins is not None):
+        abort(400)
+
     hdf5 = h5py.File(path, 'r')
     geometry = prepare_geometry(hdf5, geometry)
     slices = prepare_slices(hdf5, min_slice, max_slice)
 
     mask = get_mask(hdf5, geometry)
-    profile = extract_profile(hdf5, mask, slices)
-    profile_mask = mask[get_bounds(mask)]
-    profile = profile[profile_mask.nonzero()]
+    if stride > 1 or max_points:
+        # Only the sampled pixels are read, whatever the size of the ROI.
+        mask = subsample_mask(mask, stride, max_points)
+        profile = extract_points(hdf5, mask, slices)
+    else:
+        profile = extract_profile(hdf5, mask, slices)
+        profile_mask = mask[get_bounds(mask)]
+        profile = profile[profile_mask.nonzero()]
+
+    n_slices = slices[1] - slices[0]
+    if n_slices > 0 and (bins or (bin_size and bin_size > 1)):
+        starts = get_bin_starts(n_slices, bin_size, bins)
+        profile = bin_profile(profile, starts, bin_method)
 
     X, Y = get_cartesian_indexes(hdf5, mask) # noqa
     response = []
@@ -204,6 +246,87 @@ def _get_profile_image_projection(proj_func, format):
     return send_file(img_io, mimetype=mime_type)
 
 
+@api.route('/profile/similarity.<format>', methods=['GET', 'POST'])
+def get_profile_similarity(format):
+    path = _get_parameter()('fif', type=str)
+    geometry = wkt.loads(_get_parameter()('location', type=str))
+    if path is None or geometry is None:
+        abort(400)
+
+    min_slice = _get_parameter()('minSlice', None, type=int)
+    max_slice = _get_parameter()('maxSlice', None, type=int)
+
+    metric = _get_parameter()('metric', 'cosine', type=str)
+    if metric not in SIMILARITY_METRICS:
+        abort(400)
+
+    hdf5 = h5py.File(path, 'r')
+    geometry = prepare_geometry(hdf5, geometry)
+    slices = prepare_slices(hdf5, min_slice, max_slice)
+    mask = get_mask(hdf5, geometry)
+    if not mask.any():
+        abort(400)
+
+    reference = _get_parameter()('reference', None, type=str)
+    reference_location = _get_parameter()('referenceLocation', None, type=str)
+    if reference is not None:
+        try:
+            reference = [float(v) for v in reference.strip('[]').split(',')]
+        except ValueError:
+            abort(400)
+    elif reference_location is not None:
+        reference_geometry = prepare_geometry(hdf5, wkt.loads(reference_location))
+        reference_mask = get_mask(hdf5, reference_geometry)
+        if not reference_mask.any():
+            abort(400)
+        reference = get_mean_spectrum(hdf5, reference_mask, slices)
+    else:
+        abort(400)
+
+    if len(reference) != slices[1] - slices[0] or not np.all(np.isfinite(reference)):
+        abort(400)
+
+    similarity = get_similarity_map(hdf5, mask, slices, reference, metric)
+    similarity_mask = mask[get_bounds(mask)]
+
+    if format == 'npy':
+        similarity[~similarity_mask] = np.nan
+        array_io = BytesIO()
+        np.save(array_io, similarity)
+        array_io.seek(0)
+        return send_file(array_io, mimetype="application/octet-stream")
+
+    bpc = hdf5['bpc'][()]
+    if bpc > 8 or format not in ['jpg', 'png']:
+        format = 'png'
+
+    dtype = np.uint16 if bpc > 8 else np.uint8
+    normalized = _normalize_similarity(similarity, similarity_mask, metric)
+    image = (normalized * np.iinfo(dtype).max).astype(dtype) * similarity_mask
+
+    img = Image.fromarray(image)
+    img_io = BytesIO()
+    img.save(img_io, format)
+    img_io.seek(0)
+    mime_type = "image/jpeg" if format == "jpg" else "image/png"
+    return send_file(img_io, mimetype=mime_type)
+
+
+def _normalize_similarity(similarity, mask, metric):
+    """
+    Map similarity values to [0, 1], the most similar pixels being the brightest.
+    """
+    if metric == 'cosine':
+        return np.clip(similarity, 0, 1)
+    elif metric == 'angle':
+        return np.clip(1 - similarity / (np.pi / 2), 0, 1)
+
+    max_distance = np.max(similarity[mask])
+    if max_distance == 0:
+        return np.ones_like(similarity)
+    return 1 - similarity / max_distance
+
+
 def _get_parameter():
     if request.method == 'POST':
         return request.values.get
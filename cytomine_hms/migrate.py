@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2022. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+"""
+Rewrite existing HDF5 cubes into a new storage layout.
+
+Cubes produced by older `create_hdf5` versions store `data` as a contiguous
+(height, width, nSlices) dataset. This tool copies them, block by block and
+without going back to the image server, into a chunked (and optionally
+compressed) layout, with optional precomputed projections.
+
+Usage: python -m cytomine_hms.migrate [options] PATH [PATH ...]
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import h5py
+import numpy as np
+
+SCALAR_DATASETS = ("width", "height", "nSlices", "bpc")
+PROJECTIONS = {
+    "min": ("minProjection", np.min),
+    "max": ("maxProjection", np.max),
+    "average": ("averageProjection", np.mean),
+}
+COMPRESSIONS = ("none", "gzip", "lzf")
+DEFAULT_GZIP_LEVEL = 4
+DEFAULT_BLOCK_MEMORY = 64 * 2 ** 20
+
+
+def parse_chunks(value):
+    """
+    Parse a chunk shape given as "height,width,slices".
+    A 0 value means the full extent of the dimension.
+    """
+    try:
+        chunks = tuple(int(v) for v in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid chunk shape: {}".format(value))
+    if len(chunks) != 3 or any(c < 0 for c in chunks):
+        raise argparse.ArgumentTypeError("Invalid chunk shape: {}".format(value))
+    return chunks
+
+
+def resolve_chunks(chunks, shape):
+    """
+    Get the effective chunk shape for a dataset shape.
+    :param chunks: The requested chunk shape, 0 meaning the full extent
+    :param shape: The dataset shape
+    :return: A chunk shape valid for the dataset
+    """
+    return tuple(
+        max(1, min(s, c if c > 0 else s)) for c, s in zip(chunks, shape)
+    )
+
+
+def iter_blocks(shape, chunks, itemsize, block_memory):
+    """
+    Iterate over blocks covering the whole cube, each holding at most about
+    `block_memory` bytes. Blocks are split along the slice axis first, then
+    grown spatially, and their edges are aligned on chunk edges so that every
+    chunk is written exactly once. A block is never smaller than one chunk.
+    :param shape: The (height, width, nSlices) dataset shape
+    :param chunks: The target chunk shape
+    :param itemsize: The size of a dataset element, in bytes
+    :param block_memory: The approximate maximum size of a block, in bytes
+    :return: A generator of (row slice, column slice, slice slice)
+    """
+    height, width, n_slices = shape
+    chunk_rows, chunk_cols, chunk_slices = chunks
+
+    chunk_pixel_bytes = chunk_rows * chunk_cols * itemsize
+    block_slices = max(1, block_memory // (chunk_pixel_bytes * chunk_slices)) * chunk_slices
+    block_slices = min(block_slices, n_slices)
+
+    side = int(np.sqrt(max(1, block_memory // (block_slices * itemsize))))
+    block_rows = max(1, side // chunk_rows) * chunk_rows
+    block_cols = max(1, side // chunk_cols) * chunk_cols
+
+    for min_row in range(0, height, block_rows):
+        for min_col in range(0, width, block_cols):
+            for min_slice in range(0, n_slices, block_slices):
+                yield (
+                    slice(min_row, min(min_row + block_rows, height)),
+                    slice(min_col, min(min_col + block_cols, width)),
+                    slice(min_slice, min(min_slice + block_slices, n_slices))
+                )
+
+
+def has_layout(hdf5, chunks, compression, compression_opts, shuffle, projections):
+    """
+    Check whether a HDF5 file is already in the target layout.
+    """
+    if compression == "gzip" and compression_opts is None:
+        compression_opts = DEFAULT_GZIP_LEVEL
+
+    dataset = hdf5["data"]
+    if dataset.chunks != resolve_chunks(chunks, dataset.shape):
+        return False
+    if dataset.compression != compression:
+        return False
+    if dataset.compression_opts != compression_opts:
+        return False
+    if dataset.shuffle != shuffle:
+        return False
+    return all(PROJECTIONS[p][0] in hdf5 for p in projections)
+
+
+def copy_permissions(src, dst):
+    """
+    Give `dst` the mode, and if possible the ownership, of `src`.
+    """
+    shutil.copymode(src, dst)
+    stat = os.stat(src)
+    try:
+        os.chown(dst, stat.st_uid, stat.st_gid)
+    except PermissionError:
+        pass
+
+
+def migrate_hdf5(
+    src, dst=None, chunks=(64, 64, 0), compression=None, compression_opts=None,
+    shuffle=False, projections=(), block_memory=DEFAULT_BLOCK_MEMORY, force=False
+):
+    """
+    Rewrite a HDF5 cube into a new layout. The result is written to a
+    temporary file next to the destination, verified against the source
+    and then atomically renamed.
+    :param src: The path of the HDF5 file to migrate
+    :param dst: The destination path (defaults to `src`, replaced in place)
+    :param chunks: The target chunk shape, 0 meaning the full extent
+    :param compression: The HDF5 compression filter (None, "gzip", "lzf")
+    :param compression_opts: The compression filter options
+    :param shuffle: Whether to apply the shuffle filter
+    :param projections: Names of projections to precompute (min, max, average).
+    Other datasets of the source file, including existing projections, are
+    copied unchanged.
+    :param block_memory: The approximate maximum size of blocks copied at once, in bytes
+    :param force: Rewrite the file even if it already has the target layout
+    :return: True if the file has been rewritten, False if it was skipped
+    """
+    if dst is None:
+        dst = src
+
+    with h5py.File(src, 'r') as source:
+        if not force and src == dst and has_layout(
+            source, chunks, compression, compression_opts, shuffle, projections
+        ):
+            return False
+
+        fd, tmp_path = tempfile.mkstemp(
+            suffix=".tmp", prefix=".{}.".format(os.path.basename(dst)),
+            dir=os.path.dirname(os.path.abspath(dst))
+        )
+        os.close(fd)
+        try:
+            with h5py.File(tmp_path, 'w') as target:
+                source_checksum = _copy_cube(
+                    source, target, chunks, compression, compression_opts,
+                    shuffle, projections, block_memory
+                )
+
+            # Verify what has been written to disk, not the chunk cache.
+            with h5py.File(tmp_path, 'r') as target:
+                target_checksum = _checksum(target["data"], block_memory)
+            if source_checksum != target_checksum:
+                raise IOError("Checksum mismatch after rewriting data")
+
+            copy_permissions(src, tmp_path)
+            os.replace(tmp_path, dst)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    return True
+
+
+def _copy_cube(
+    source, target, chunks, compression, compression_opts, shuffle,
+    projections, block_memory
+):
+    for name in SCALAR_DATASETS:
+        target.create_dataset(name, data=source[name][()], shape=())
+
+    data = source["data"]
+    chunks = resolve_chunks(chunks, data.shape)
+    dataset = target.create_dataset(
+        "data", shape=data.shape, dtype=data.dtype, chunks=chunks,
+        compression=compression, compression_opts=compression_opts,
+        shuffle=shuffle
+    )
+    dataset.attrs.update(data.attrs)
+
+    projection_datasets = dict()
+    for p in projections:
+        name, _ = PROJECTIONS[p]
+        projection_datasets[p] = target.create_dataset(
+            name, shape=data.shape[:2], dtype=data.dtype,
+            chunks=chunks[:2], compression=compression,
+            compression_opts=compression_opts
+        )
+
+    # Anything else (attributes, existing projections, ...) is kept as is.
+    target.attrs.update(source.attrs)
+    for name in source:
+        if name not in target:
+            source.copy(source[name], target, name)
+
+    source_checksum = hashlib.sha256()
+    accumulators = dict()
+    for rows, cols, slices in iter_blocks(data.shape, chunks, data.dtype.itemsize, block_memory):
+        block = data[rows, cols, slices]
+        source_checksum.update(np.ascontiguousarray(block).data)
+        dataset[rows, cols, slices] = block
+        if not projection_datasets:
+            continue
+
+        if slices.start == 0:
+            accumulators = {
+                "min": np.min(block, axis=-1),
+                "max": np.max(block, axis=-1),
+                "average": np.sum(block, axis=-1, dtype=np.float64),
+            }
+        else:
+            accumulators["min"] = np.minimum(accumulators["min"], np.min(block, axis=-1))
+            accumulators["max"] = np.maximum(accumulators["max"], np.max(block, axis=-1))
+            accumulators["average"] += np.sum(block, axis=-1, dtype=np.float64)
+
+        if slices.stop == data.shape[2]:
+            accumulators["average"] /= data.shape[2]
+            for p, projection_dataset in projection_datasets.items():
+                projection_dataset[rows, cols] = accumulators[p].astype(data.dtype)
+
+    return source_checksum.digest()
+
+
+def _checksum(dataset, block_memory):
+    checksum = hashlib.sha256()
+    for bounds in iter_blocks(
+        dataset.shape, dataset.chunks, dataset.dtype.itemsize, block_memory
+    ):
+        checksum.update(np.ascontiguousarray(dataset[bounds]).data)
+    return checksum.digest()
+
+
+def find_hdf5_files(paths, pattern):
+    """
+    Expand the given paths: files are kept as is, directories are walked
+    recursively for files matching `pattern`.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, _, filenames in os.walk(path):
+                for filename in sorted(fnmatch.filter(filenames, pattern)):
+                    yield os.path.join(dir_path, filename)
+        else:
+            yield path
+
+
+def _migrate_one(path, kwargs):
+    try:
+        return path, migrate_hdf5(path, **kwargs), None
+    except Exception as e:
+        return path, False, "{}: {}".format(type(e).__name__, e)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m cytomine_hms.migrate",
+        description="Rewrite existing HDF5 cubes into a new storage layout."
+    )
+    parser.add_argument(
+        "paths", nargs="+",
+        help="HDF5 files, or directories searched recursively"
+    )
+    parser.add_argument(
+        "--pattern", default="*.hdf5",
+        help="Filename pattern used when searching directories (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--chunks", type=parse_chunks, default=(64, 64, 0),
+        help="Target chunk shape as height,width,slices, 0 meaning "
+             "the full extent (default: 64,64,0)"
+    )
+    parser.add_argument(
+        "--compression", choices=COMPRESSIONS, default="none",
+        help="Compression filter (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--compression-level", type=int, default=None,
+        help="Compression level, for gzip only"
+    )
+    parser.add_argument(
+        "--shuffle", action="store_true",
+        help="Apply the shuffle filter before compression"
+    )
+    parser.add_argument(
+        "--projection", dest="projections", action="append",
+        choices=sorted(PROJECTIONS.keys()), default=[],
+        help="Precompute a projection dataset (can be repeated)"
+    )
+    parser.add_argument(
+        "--block-memory", type=int, default=DEFAULT_BLOCK_MEMORY // 2 ** 20,
+        help="Approximate maximum size of blocks copied at once by each "
+             "worker, in MiB (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=0,
+        help="Number of worker processes, 0 for one per CPU (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Rewrite files even if they already have the target layout"
+    )
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    compression = None if args.compression == "none" else args.compression
+    compression_opts = args.compression_level if compression == "gzip" else None
+    kwargs = dict(
+        chunks=args.chunks, compression=compression,
+        compression_opts=compression_opts, shuffle=args.shuffle,
+        projections=tuple(args.projections),
+        block_memory=args.block_memory * 2 ** 20,
+        force=args.force
+    )
+
+    n_workers = args.workers if args.workers > 0 else os.cpu_count()
+    paths = list(find_hdf5_files(args.paths, args.pattern))
+    n_errors = 0
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_migrate_one, path, kwargs) for path in paths]
+        for future in as_completed(futures):
+            path, migrated, error = future.result()
+            if error:
+                n_errors += 1
+                print("{} | ERROR: {}".format(path, error), file=sys.stderr)
+            else:
+                print("{} | {}".format(path, "Migrated" if migrated else "Skipped"))
+
+    print("{} file(s) processed, {} error(s)".format(len(paths), n_errors))
+    return 1 if n_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -73,6 +73,43 @@ def get_bounds(mask):
     return np.s_[np.min(i):np.max(i)+1, np.min(j):np.max(j)+1]
 
 
+def subsample_mask(mask, stride=1, max_points=None):
+    """
+    Keep a deterministic subset of the pixels of a geometry mask. The mask
+    bounds are split in cells of `stride` x `stride` pixels, and the first
+    mask pixel of each cell (in row-major order) is kept, so that only
+    pixels of the geometry are returned, thin ones included. If `max_points`
+    is given, the stride is increased so that an area has at least `max_points`
+    cells, and evenly spaced pixels are then dropped so that at most
+    `max_points` remain.
+    :param mask: The geometry mask
+    :param stride: The minimum cell side, in pixels
+    :param max_points: The maximum number of pixels to keep
+    :return: The subsampled mask
+    """
+    i, j = mask.nonzero()
+    if len(i) == 0:
+        return mask
+
+    if max_points and len(i) > max_points:
+        stride = max(stride, int(np.sqrt(len(i) / max_points)))
+
+    if stride > 1:
+        n_cell_cols = (j.max() - j.min()) // stride + 1
+        cells = ((i - i.min()) // stride) * n_cell_cols + (j - j.min()) // stride
+        _, first = np.unique(cells, return_index=True)
+        first.sort()
+        i, j = i[first], j[first]
+
+    if max_points and len(i) > max_points:
+        keep = np.linspace(0, len(i) - 1, max_points).round().astype(int)
+        i, j = i[keep], j[keep]
+
+    sampled = np.zeros_like(mask)
+    sampled[i, j] = True
+    return sampled
+
+
 def extract_profile(hdf5, mask, slices):
     """
     Get profile data as matrix
@@ -85,6 +122,58 @@ def extract_profile(hdf5, mask, slices):
     return hdf5['data'][bounds]
 
 
+def extract_points(hdf5, mask, slices):
+    """
+    Get profile data of the mask pixels only, in row-major order. Unlike
+    `extract_profile`, the mask bounds are not read: pixels are read row by
+    row, so that reading a sparse mask costs as many spectra as it has pixels.
+    :param hdf5: The HD5 file with profile data
+    :param mask: The geometry mask
+    :param slices: A Python slice of image slices
+    :return: The profiles, as a (nPixels, nSlices) matrix
+    """
+    dataset = hdf5['data']
+    i, j = mask.nonzero()
+    profile = np.empty((len(i), slices[1] - slices[0]), dtype=dataset.dtype)
+    rows, starts = np.unique(i, return_index=True)
+    ends = np.append(starts[1:], len(i))
+    for row, start, end in zip(rows, starts, ends):
+        profile[start:end] = dataset[row, j[start:end], slice(*slices)]
+    return profile
+
+
+BIN_METHODS = ('mean', 'max')
+
+
+def get_bin_starts(n_slices, bin_size=None, bins=None):
+    """
+    Get the first slice of each bin, either for bins of `bin_size` slices
+    (the last bin being smaller if needed) or for `bins` bins of about the
+    same size. There are fewer than `bins` bins if there are fewer slices.
+    :param n_slices: The number of slices
+    :param bin_size: The number of slices per bin
+    :param bins: The number of bins
+    :return: The first slice of each bin
+    """
+    if bins:
+        return np.unique(np.linspace(0, n_slices, bins + 1)[:-1].round().astype(int))
+    return np.arange(0, n_slices, bin_size)
+
+
+def bin_profile(profile, starts, method='mean'):
+    """
+    Aggregate consecutive slices of profiles.
+    :param profile: The profiles, slices being the last axis
+    :param starts: The first slice of each bin, as given by `get_bin_starts`
+    :param method: The aggregation method, one of BIN_METHODS
+    :return: The binned profiles
+    """
+    if method == 'mean':
+        sums = np.add.reduceat(profile, starts, axis=-1, dtype=np.float64)
+        return sums / np.diff(np.append(starts, profile.shape[-1]))
+    return np.maximum.reduceat(profile, starts, axis=-1)
+
+
 def get_projection(profile, proj_func, axis=-1):
     return proj_func(profile, axis=axis)
 
@@ -95,3 +184,80 @@ def get_cartesian_indexes(hdf5, mask):
     y_indexes = image_height - 1 - y_indexes
 
     return x_indexes, y_indexes
+
+
+def get_mean_spectrum(hdf5, mask, slices):
+    """
+    Get the mean spectrum of the pixels in a geometry mask
+    :param hdf5: The HDF5 file with profile data
+    :param mask: The geometry mask
+    :param slices: A Python slice of image slices
+    :return: The mean spectrum, as a 1D array
+    """
+    profile = extract_profile(hdf5, mask, slices)
+    profile_mask = mask[get_bounds(mask)]
+    return np.mean(profile[profile_mask.nonzero()], axis=0)
+
+
+def _cosine_similarity(block, reference):
+    norms = np.linalg.norm(block, axis=-1) * np.linalg.norm(reference)
+    dots = block @ reference
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = np.where(norms > 0, dots / norms, 0)
+    return np.clip(similarity, -1, 1)
+
+
+def _spectral_angle(block, reference):
+    return np.arccos(_cosine_similarity(block, reference))
+
+
+def _euclidean_distance(block, reference):
+    return np.linalg.norm(block - reference, axis=-1)
+
+
+SIMILARITY_METRICS = {
+    'cosine': _cosine_similarity,
+    'angle': _spectral_angle,
+    'euclidean': _euclidean_distance,
+}
+
+
+def get_similarity_map(
+    hdf5, mask, slices, reference, metric='cosine', block_memory=64 * 2 ** 20
+):
+    """
+    Compute a per-pixel similarity map between a reference spectrum and the
+    spectra in the bounds of a geometry mask. The cube is read by spatial
+    blocks holding at most about `block_memory` bytes once converted to
+    float32, so that memory usage depends neither on the region size nor
+    on the number of slices (a block has at least one pixel).
+    :param hdf5: The HDF5 file with profile data
+    :param mask: The geometry mask
+    :param slices: A Python slice of image slices
+    :param reference: The reference spectrum, with one value per slice
+    :param metric: The similarity metric, one of SIMILARITY_METRICS
+    :param block_memory: The approximate maximum size of a block, in bytes
+    :return: The similarity map in mask bounds, as float32 matrix
+    """
+    metric_func = SIMILARITY_METRICS[metric]
+    reference = np.asarray(reference, dtype=np.float32)
+    rows, cols = get_bounds(mask)
+    dataset = hdf5['data']
+    height, width = rows.stop - rows.start, cols.stop - cols.start
+
+    n_pixels = max(1, block_memory // (max(1, len(reference)) * 4))
+    block_cols = min(width, n_pixels)
+    block_rows = max(1, n_pixels // block_cols)
+
+    similarity = np.empty((height, width), dtype=np.float32)
+    for min_row in range(0, height, block_rows):
+        max_row = min(min_row + block_rows, height)
+        for min_col in range(0, width, block_cols):
+            max_col = min(min_col + block_cols, width)
+            block = dataset[
+                rows.start + min_row:rows.start + max_row,
+                cols.start + min_col:cols.start + max_col,
+                slice(*slices)
+            ].astype(np.float32)
+            similarity[min_row:max_row, min_col:max_col] = metric_func(block, reference)
+    return similarity
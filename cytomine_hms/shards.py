@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2022. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+import glob
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from threading import Event, Thread
+
+import h5py
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+def get_table_path(path):
+    return "{}.shards.sqlite".format(path)
+
+
+def get_part_path(path, shard_id):
+    return "{}.part{:05d}".format(path, shard_id)
+
+
+def get_shard_bounds(shard, tile_size, height, width):
+    """
+    Get the pixel bounds of a shard in the image
+    :param shard: The shard, with bounds in tiles
+    :param tile_size: The tile size
+    :param height: The image height
+    :param width: The image width
+    :return: The (row slice, column slice) of the shard
+    """
+    return (
+        slice(shard['min_y'] * tile_size, min(shard['max_y'] * tile_size, height)),
+        slice(shard['min_x'] * tile_size, min(shard['max_x'] * tile_size, width))
+    )
+
+
+class ShardTable:
+    """
+    Lease table coordinating the workers of a sharded conversion. It is a
+    SQLite database stored next to the converted file, so that any worker
+    with access to the file system can take part in the conversion.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+
+    @contextmanager
+    def _transaction(self):
+        connection = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None
+        )
+        connection.row_factory = sqlite3.Row
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def initialize(self, x_tiles, y_tiles, shard_size, reset=False, stale_after=None):
+        """
+        Split the tile grid in shards of `shard_size` x `shard_size` tiles.
+        Calls made once the table exists have no effect (the caller joins the
+        existing conversion), unless `reset` is given and the conversion is
+        over: it has been finalized, or its finalizer claimed the final step
+        more than `stale_after` seconds ago and is presumably dead.
+        :return: True if the table has been initialized by this call
+        """
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS shards ("
+                "id INTEGER PRIMARY KEY, "
+                "min_x INTEGER NOT NULL, min_y INTEGER NOT NULL, "
+                "max_x INTEGER NOT NULL, max_y INTEGER NOT NULL, "
+                "status TEXT NOT NULL, owner TEXT, expires REAL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            if self._get_state(db, 'initialized'):
+                if not reset or not self._is_over(db, stale_after):
+                    return False
+                db.execute("DELETE FROM shards")
+                db.execute("DELETE FROM state")
+
+            for min_y in range(0, y_tiles, shard_size):
+                for min_x in range(0, x_tiles, shard_size):
+                    db.execute(
+                        "INSERT INTO shards (min_x, min_y, max_x, max_y, status) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (
+                            min_x, min_y, min(min_x + shard_size, x_tiles),
+                            min(min_y + shard_size, y_tiles), PENDING
+                        )
+                    )
+            db.execute("INSERT INTO state VALUES ('initialized', ?)", (time.time(),))
+            return True
+
+    def acquire(self, owner, lease_duration):
+        """
+        Lease a pending shard, or a shard whose lease has expired.
+        :return: The leased shard as a dict, or None if there is no shard left
+        """
+        now = time.time()
+        with self._transaction() as db:
+            if self._is_failed(db) or self._get_state(db, 'finalizer'):
+                return None
+            shard = db.execute(
+                "SELECT * FROM shards WHERE status = ? OR (status = ? AND expires < ?) "
+                "ORDER BY id LIMIT 1",
+                (PENDING, LEASED, now)
+            ).fetchone()
+            if shard is None:
+                return None
+            db.execute(
+                "UPDATE shards SET status = ?, owner = ?, expires = ? WHERE id = ?",
+                (LEASED, owner, now + lease_duration, shard['id'])
+            )
+            return dict(shard)
+
+    def renew(self, shard_id, owner, lease_duration):
+        """
+        Extend a lease.
+        :return: True if the shard is still leased by `owner`
+        """
+        return self._set_status(
+            shard_id, owner, LEASED, time.time() + lease_duration
+        )
+
+    def complete(self, shard_id, owner):
+        return self._set_status(shard_id, owner, DONE)
+
+    def fail(self, shard_id, owner):
+        return self._set_status(shard_id, owner, FAILED)
+
+    def _set_status(self, shard_id, owner, status, expires=None):
+        with self._transaction() as db:
+            if self._get_state(db, 'finalizer'):
+                return False
+            cursor = db.execute(
+                "UPDATE shards SET status = ?, expires = ? "
+                "WHERE id = ? AND owner = ? AND status = ?",
+                (status, expires, shard_id, owner, LEASED)
+            )
+            return cursor.rowcount == 1
+
+    @staticmethod
+    def _get_state(db, key):
+        row = db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _is_over(self, db, stale_after):
+        if self._get_state(db, 'finalized'):
+            return True
+        claimed = self._get_state(db, 'finalizer_time')
+        return claimed is not None and stale_after is not None \
+            and float(claimed) + stale_after < time.time()
+
+    @staticmethod
+    def _is_failed(db):
+        return db.execute(
+            "SELECT COUNT(*) FROM shards WHERE status = ?", (FAILED,)
+        ).fetchone()[0] > 0
+
+    def is_running(self):
+        """
+        :return: True if shards remain to be written by this conversion
+        """
+        with self._transaction() as db:
+            if self._is_failed(db) or self._get_state(db, 'finalizer'):
+                return False
+            return db.execute(
+                "SELECT COUNT(*) FROM shards WHERE status IN (?, ?)",
+                (PENDING, LEASED)
+            ).fetchone()[0] > 0
+
+    def counts(self):
+        """
+        :return: The number of shards per status
+        """
+        with self._transaction() as db:
+            rows = db.execute(
+                "SELECT status, COUNT(*) FROM shards GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def shards(self):
+        with self._transaction() as db:
+            return [dict(s) for s in db.execute("SELECT * FROM shards ORDER BY id")]
+
+    def claim_finalization(self, owner):
+        """
+        Claim the final step of the conversion. It can be claimed once,
+        when no shard remains to be written (or when a shard failed).
+        :return: True if `owner` must finalize the conversion
+        """
+        with self._transaction() as db:
+            if self._get_state(db, 'finalizer'):
+                return False
+
+            remaining = db.execute(
+                "SELECT COUNT(*) FROM shards WHERE status IN (?, ?)",
+                (PENDING, LEASED)
+            ).fetchone()[0]
+            if remaining > 0 and not self._is_failed(db):
+                return False
+
+            db.execute("INSERT INTO state VALUES ('finalizer', ?)", (owner,))
+            db.execute("INSERT INTO state VALUES ('finalizer_time', ?)", (time.time(),))
+            return True
+
+    def finish(self, owner):
+        """
+        Mark the conversion as finalized, once its finalizer is done.
+        Only then can the table be reset for a new conversion.
+        """
+        with self._transaction() as db:
+            if self._get_state(db, 'finalizer') == owner:
+                db.execute("INSERT OR REPLACE INTO state VALUES ('finalized', ?)", (time.time(),))
+
+
+class LeaseHeartbeat(Thread):
+    """
+    Periodically renew a shard lease while it is being written, so that
+    lease bookkeeping never runs in the tile writer thread.
+    """
+
+    def __init__(self, table, shard_id, owner, lease_duration):
+        super().__init__(daemon=True)
+        self.table = table
+        self.shard_id = shard_id
+        self.owner = owner
+        self.lease_duration = lease_duration
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self.lease_duration / 3):
+            try:
+                self.table.renew(self.shard_id, self.owner, self.lease_duration)
+            except sqlite3.Error as e:
+                logger.warning("Cannot renew lease of shard %s: %s", self.shard_id, e)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def remove_parts(path, tmp_only=False):
+    """
+    Remove the part files of a sharded conversion.
+    :param path: The path of the final HDF5 file
+    :param tmp_only: Only remove temporary part files left by workers
+    """
+    pattern = "{}.part*.tmp" if tmp_only else "{}.part*"
+    for part_path in glob.glob(pattern.format(glob.escape(path))):
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+
+def assemble_virtual_dataset(path, shards, tile_size, scalars, shape, dtype):
+    """
+    Write the final HDF5 file, whose `data` dataset is a virtual dataset
+    made of the `data` datasets of the shard part files. Part files are
+    referenced relatively to the final file directory.
+    :param path: The path of the final HDF5 file
+    :param shards: The shards to assemble
+    :param tile_size: The tile size
+    :param scalars: The scalar datasets (width, height, nSlices, bpc) to write
+    :param shape: The (height, width, nSlices) shape of the `data` dataset
+    :param dtype: The type of the `data` dataset
+    """
+    layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+    for shard in shards:
+        rows, cols = get_shard_bounds(shard, tile_size, shape[0], shape[1])
+        part_shape = (rows.stop - rows.start, cols.stop - cols.start, shape[2])
+        part_name = os.path.basename(get_part_path(path, shard['id']))
+        layout[rows, cols, :] = h5py.VirtualSource(part_name, "data", shape=part_shape)
+
+    fd, tmp_path = tempfile.mkstemp(
+        suffix=".tmp", prefix=".{}.".format(os.path.basename(path)),
+        dir=os.path.dirname(os.path.abspath(path))
+    )
+    os.close(fd)
+    try:
+        with h5py.File(tmp_path, 'w') as hdf5:
+            for name, value in scalars.items():
+                hdf5.create_dataset(name, data=value, shape=())
+            hdf5.create_virtual_dataset("data", layout, fillvalue=0)
+        # mkstemp creates owner-only files, part files have default permissions.
+        shutil.copymode(get_part_path(path, shards[0]['id']), tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -15,6 +15,8 @@
 # * limitations under the License.
 
 import os
+import socket
+import uuid
 from io import BytesIO
 from queue import Queue
 from threading import Thread
@@ -26,8 +28,18 @@ import time
 from PIL import Image
 from cytomine.models import UploadedFile
 
+from .shards import ShardTable, LeaseHeartbeat, get_table_path, get_part_path, \
+    get_shard_bounds, assemble_virtual_dataset, remove_parts, DONE, FAILED
+
 DEBUG = False
 
+TILE_FORMATS = {
+    'raw': 'application/octet-stream',
+    'tiff': 'image/tiff',
+    'png': 'image/png',
+}
+DEFAULT_TILE_FORMATS = ('raw', 'tiff', 'png')
+
 
 def get_image_dimension(image):
     if image.channels > 1:
@@ -42,7 +54,7 @@ def get_image_dimension(image):
 
 def create_hdf5(
     uploaded_file, image, slices, cf, n_workers=0, tile_size=512,
-    n_written_tiles_to_update=50, root=""
+    n_written_tiles_to_update=50, root="", formats=DEFAULT_TILE_FORMATS
 ):
     image_name = image.originalFilename
     dimension = get_image_dimension(image)
@@ -76,6 +88,293 @@ def create_hdf5(
     y_tiles = int(np.ceil(image.height / tile_size))
     n_blocks = x_tiles * y_tiles * len(slices)
 
+    def on_written(counter):
+        if counter % n_written_tiles_to_update == 0 or counter == n_blocks:
+            progress = (counter / n_blocks * 100)
+            cf.progress = int(round(progress))
+            cf.update()
+            log("{} | Write {}% ({}/{})".format(
+                image_name, progress, counter, n_blocks
+            ),)
+
+    tiles = get_tiles(slices, range(x_tiles), range(y_tiles), x_tiles)
+    success = write_tiles(
+        tiles, dataset, image, bpc, n_workers, tile_size, on_written,
+        formats=formats
+    )
+
+    uploaded_file = uploaded_file.fetch()
+    cf = cf.fetch()
+    if not success:
+        uploaded_file.status = uploaded_file.ERROR_CONVERSION
+    elif uploaded_file.status == UploadedFile.CONVERTING:
+        uploaded_file.status = uploaded_file.CONVERTED
+
+    uploaded_file.size = os.path.getsize(path)
+    retry_update(uploaded_file)
+    retry_update(cf)
+
+    hdf5.close()
+
+
+def create_hdf5_sharded(
+    uploaded_file, image, slices, cf, n_workers=0, tile_size=512,
+    n_written_tiles_to_update=50, root="", shard_size=8, lease_duration=600,
+    formats=DEFAULT_TILE_FORMATS, poll_interval=10, reconvert=False
+):
+    """
+    Take part in a sharded conversion. The tile grid is split in shards of
+    `shard_size` x `shard_size` tiles, coordinated through a lease table
+    stored next to the converted file. Each shard is written in its own part
+    file, by any worker with access to `root`. Workers wait for shards leased
+    by others, so that shards of dead workers are taken over once their lease
+    expires. The worker finishing last assembles the part files in a virtual
+    `data` dataset, so that readers see the same schema as with `create_hdf5`.
+    Once a conversion is over, joining it has no effect: a new conversion
+    of the same file is only started with `reconvert`.
+    """
+    image_name = image.originalFilename
+    dimension = get_image_dimension(image)
+    if not dimension:
+        log("{} | ERROR: Cannot make profile for 2D image".format(image_name))
+        uploaded_file.status = uploaded_file.ERROR_CONVERSION
+        retry_update(uploaded_file)
+        return
+
+    path = os.path.join(root, uploaded_file.path)
+    dir_path = os.path.dirname(path)
+    os.makedirs(dir_path, exist_ok=True)
+
+    bpc = image.bitPerSample if image.bitPerSample else 8
+    dtype = np.uint16 if bpc > 8 else np.uint8
+    x_tiles = int(np.ceil(image.width / tile_size))
+    y_tiles = int(np.ceil(image.height / tile_size))
+
+    table = ShardTable(get_table_path(path))
+    if table.initialize(
+        x_tiles, y_tiles, shard_size, reset=reconvert, stale_after=lease_duration
+    ):
+        uploaded_file.status = UploadedFile.CONVERTING
+        retry_update(uploaded_file)
+        retry_update(cf)
+
+    owner = "{}:{}".format(socket.gethostname(), uuid.uuid4().hex)
+    while True:
+        shard = table.acquire(owner, lease_duration)
+        if shard is None:
+            if table.is_running():
+                time.sleep(poll_interval)
+                continue
+            break
+
+        log("{} | Shard {} leased by {}".format(image_name, shard['id'], owner))
+        rows, cols = get_shard_bounds(shard, tile_size, image.height, image.width)
+        part_path = get_part_path(path, shard['id'])
+        tmp_path = "{}.{}.tmp".format(part_path, uuid.uuid4().hex)
+
+        heartbeat = LeaseHeartbeat(table, shard['id'], owner, lease_duration)
+        heartbeat.start()
+        try:
+            with h5py.File(tmp_path, 'w') as part:
+                dataset = part.create_dataset(
+                    "data", dtype=dtype, shape=(
+                        rows.stop - rows.start, cols.stop - cols.start, len(slices)
+                    )
+                )
+                tiles = get_tiles(
+                    slices, range(shard['min_x'], shard['max_x']),
+                    range(shard['min_y'], shard['max_y']), x_tiles
+                )
+                success = write_tiles(
+                    tiles, dataset, image, bpc, n_workers, tile_size,
+                    origin=(rows.start, cols.start), formats=formats
+                )
+        except Exception as e:
+            log("{} | ERROR shard {}: {}".format(image_name, shard['id'], e), force=True)
+            success = False
+        finally:
+            heartbeat.stop()
+
+        if not success:
+            table.fail(shard['id'], owner)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            break
+
+        # The lease may have expired and been taken over by another worker,
+        # or the conversion may have been finalized after a failure.
+        try:
+            if table.renew(shard['id'], owner, lease_duration):
+                os.replace(tmp_path, part_path)
+                table.complete(shard['id'], owner)
+            else:
+                os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+        counts = table.counts()
+        cf.progress = int(round(counts.get(DONE, 0) / sum(counts.values()) * 100))
+        cf.update()
+
+    if not table.claim_finalization(owner):
+        return
+
+    uploaded_file = uploaded_file.fetch()
+    cf = cf.fetch()
+    shards = table.shards()
+    remove_parts(path, tmp_only=True)
+    if any(s['status'] == FAILED for s in shards):
+        remove_parts(path)
+        if os.path.exists(path):
+            os.remove(path)
+        uploaded_file.status = uploaded_file.ERROR_CONVERSION
+    else:
+        scalars = {
+            "width": image.width,
+            "height": image.height,
+            "nSlices": len(slices),
+            "bpc": bpc
+        }
+        shape = (image.height, image.width, len(slices))
+        assemble_virtual_dataset(path, shards, tile_size, scalars, shape, dtype)
+        log("{} | Assembled {} shards".format(image_name, len(shards)))
+
+        if uploaded_file.status == UploadedFile.CONVERTING:
+            uploaded_file.status = uploaded_file.CONVERTED
+        uploaded_file.size = os.path.getsize(path) + sum(
+            os.path.getsize(get_part_path(path, s['id'])) for s in shards
+        )
+
+    retry_update(uploaded_file)
+    retry_update(cf)
+    table.finish(owner)
+
+
+def get_tiles(slices, x_range, y_range, x_tiles):
+    return [
+        {
+            "X": x,
+            "Y": y,
+            "tileIndex": x + (y * x_tiles),
+            "slice": _slice
+        }
+        for _slice in slices for x in x_range for y in y_range
+    ]
+
+
+def get_accept_header(formats):
+    """
+    Build the Accept header of tile requests, giving decreasing preference
+    to the tile formats in the given order.
+    """
+    return ", ".join(
+        "{};q={:.1f}".format(TILE_FORMATS[f], max(0.1, 1 - 0.1 * i))
+        for i, f in enumerate(formats)
+    )
+
+
+def read_raw_tile(response, height, width, dtype):
+    """
+    Read a raw tile response into a preallocated array, without buffering
+    the whole body (urllib3 still copies each chunk read from the socket).
+    The response body is a C-ordered array, whose shape and little-endian
+    type are given by the `X-Array-Shape` and `X-Array-Dtype` headers.
+    """
+    shape = tuple(int(v) for v in response.headers['X-Array-Shape'].split(','))
+    if shape != (height, width):
+        raise ValueError("Unexpected raw tile shape {}".format(shape))
+
+    expected_dtype = np.dtype(dtype).newbyteorder('<')
+    raw_dtype = np.dtype(response.headers.get('X-Array-Dtype', expected_dtype.str))
+    if raw_dtype != raw_dtype.newbyteorder('<'):
+        raise ValueError("Unsupported raw tile byte order {}".format(raw_dtype.str))
+    if raw_dtype != expected_dtype:
+        raise ValueError("Unexpected raw tile type {}".format(raw_dtype.str))
+
+    tile = np.empty(shape, dtype=raw_dtype)
+    buffer = memoryview(tile).cast('B')
+    n_read = 0
+    while n_read < len(buffer):
+        n = response.raw.readinto(buffer[n_read:])
+        if not n:
+            raise IOError("Truncated raw tile ({}/{} bytes)".format(n_read, len(buffer)))
+        n_read += n
+    return tile
+
+
+def parse_tile_formats(value):
+    """
+    Parse a comma-separated list of tile formats, by order of preference.
+    """
+    formats = tuple(f.strip().lower() for f in value.split(',') if f.strip())
+    if not formats or any(f not in TILE_FORMATS for f in formats):
+        raise ValueError("Invalid TILE_FORMATS: {}".format(value))
+    return formats
+
+
+def get_tile(tile_info, image, bpc, tile_size, formats=DEFAULT_TILE_FORMATS):
+    """
+    Fetch a tile from the image server, negotiating its format with the
+    Accept header. Raw tiles are read into a preallocated array by
+    `read_raw_tile`. TIFF and PNG tiles are decoded with Pillow from the
+    buffered response body, so they cost several copies: uncompressed TIFF
+    only saves the PNG encoding and decoding work.
+    """
+    host = tile_info['slice'].imageServerUrl
+    imagepath = tile_info['slice'].path
+    url = f"{host}/image/{imagepath}/window"
+    top_left_x = tile_info['X'] * tile_size
+    top_left_y = tile_info['Y'] * tile_size
+    width = min(tile_size, image.width - top_left_x)
+    height = min(tile_size, image.height - top_left_y)
+    parameters = {
+        "region": {
+            "left": top_left_x,
+            "top": top_left_y,
+            "width": width,
+            "height": height,
+        },
+        "level": 0,
+        "bits": bpc,
+        "colorspace": "GRAY",
+        "channels": tile_info['slice'].channel,
+        "z_slices": tile_info['slice'].zStack,
+        "timepoints": tile_info['slice'].time
+    }
+    headers = {
+        "Accept": get_accept_header(formats),
+        "Accept-Encoding": "identity"
+    }
+
+    with requests.post(url, json=parameters, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        if content_type == TILE_FORMATS['raw']:
+            dtype = np.uint16 if bpc > 8 else np.uint8
+            return read_raw_tile(response, height, width, dtype)
+        return np.asarray(Image.open(BytesIO(response.content)))
+
+
+def write_tiles(
+    tiles, dataset, image, bpc, n_workers=0, tile_size=512, on_written=None,
+    origin=(0, 0), formats=DEFAULT_TILE_FORMATS
+):
+    """
+    Fetch tiles from the image server with a pool of reader threads and
+    write them in a dataset with a single writer thread.
+    :param tiles: The tiles to fetch, as given by `get_tiles`
+    :param dataset: The (height, width, nSlices) HDF5 dataset to write in
+    :param image: The image the tiles belong to
+    :param bpc: The number of bits per channel
+    :param n_workers: The number of reader threads (0 for one per CPU minus one)
+    :param tile_size: The tile size
+    :param on_written: Callback called with the number of written tiles
+    :param origin: The (row, column) of the dataset top-left pixel in the image
+    :param formats: The tile formats to request, by order of preference
+    :return: True if all tiles have been written, False otherwise
+    """
+    image_name = image.originalFilename
+
     def tile_worker(_in, _out, _error):
         while True:
             if not _out.full():
@@ -83,7 +382,7 @@ def create_hdf5(
                 if item is None:
                     return
                 try:
-                    _out.put((item, get_tile(item)))
+                    _out.put((item, get_tile(item, image, bpc, tile_size, formats)))
                     log("{} | Read tile {} {} {}".format(
                         image_name, item['X'], item['Y'], item['slice'].channel
                     ))
@@ -100,31 +399,6 @@ def create_hdf5(
                 else:
                     time.sleep(0.5)
 
-    def get_tile(tile_info):
-        host = tile_info['slice'].imageServerUrl
-        imagepath = tile_info['slice'].path
-        url = f"{host}/image/{imagepath}/window.png"
-        top_left_x = tile_info['X'] * tile_size
-        top_left_y = tile_info['Y'] * tile_size
-        parameters = {
-            "region": {
-                "left": top_left_x,
-                "top": top_left_y,
-                "width": min(tile_size, image.width - top_left_x),
-                "height": min(tile_size, image.height - top_left_y),
-            },
-            "level": 0,
-            "bits": bpc,
-            "colorspace": "GRAY",
-            "channels": tile_info['slice'].channel,
-            "z_slices": tile_info['slice'].zStack,
-            "timepoints": tile_info['slice'].time
-        }
-
-        response = requests.post(url, json=parameters)
-        tile = np.asarray(Image.open(BytesIO(response.content)))
-        return tile
-
     def writer_worker(_out, _error):
         counter = 0
         while True:
@@ -137,13 +411,8 @@ def create_hdf5(
                 try:
                     write_tile(*item)
 
-                    if counter % n_written_tiles_to_update == 0 or counter == n_blocks:
-                        progress = (counter / n_blocks * 100)
-                        cf.progress = int(round(progress))
-                        cf.update()
-                        log("{} | Write {}% ({}/{})".format(
-                            image_name, progress, counter, n_blocks
-                        ),)
+                    if on_written is not None:
+                        on_written(counter)
                 except Exception as e:
                     tile_info, _ = item
                     log(
@@ -160,9 +429,9 @@ def create_hdf5(
 
     def write_tile(tile_info, tile_data):
         height, width = tile_data.shape
-        min_row = tile_info['Y'] * tile_size
+        min_row = tile_info['Y'] * tile_size - origin[0]
         max_row = min_row + height
-        min_col = tile_info['X'] * tile_size
+        min_col = tile_info['X'] * tile_size - origin[1]
         max_col = min_col + width
         dataset[min_row:max_row, min_col:max_col, tile_info['slice'].rank] = tile_data
 
@@ -172,15 +441,8 @@ def create_hdf5(
     read_queue = Queue()
     write_queue = Queue(512)
     error_queue = Queue()
-    for _slice in slices:
-        for x in range(x_tiles):
-            for y in range(y_tiles):
-                read_queue.put({
-                    "X": x,
-                    "Y": y,
-                    "tileIndex": x + (y * x_tiles),
-                    "slice": _slice
-                })
+    for tile in tiles:
+        read_queue.put(tile)
 
     for _ in range(n_workers):
         read_queue.put(None)
@@ -202,18 +464,7 @@ def create_hdf5(
     write_queue.put(None)
     write_worker.join()
 
-    uploaded_file = uploaded_file.fetch()
-    cf = cf.fetch()
-    if not error_queue.empty():
-        uploaded_file.status = uploaded_file.ERROR_CONVERSION
-    elif uploaded_file.status == UploadedFile.CONVERTING:
-        uploaded_file.status = uploaded_file.CONVERTED
-
-    uploaded_file.size = os.path.getsize(path)
-    retry_update(uploaded_file)
-    retry_update(cf)
-
-    hdf5.close()
+    return error_queue.empty()
 
 
 def retry_update(obj, retries=5):
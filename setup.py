@@ -58,6 +58,11 @@ setup(
     install_requires=REQUIRED,
     dependency_links=DEPENDENCY_LINKS,
     include_package_data=True,
+    entry_points={
+        'console_scripts': [
+            'cytomine-hms-migrate=cytomine_hms.migrate:main',
+        ],
+    },
     classifiers=[
         # Trove classifiers
         # Full list: https://pypi.python.org/pypi?%3Aaction=list_classifiers
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2022. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from cytomine_hms import migrate
+from cytomine_hms.migrate import migrate_hdf5, iter_blocks, main
+
+
+@pytest.fixture
+def data():
+    return np.random.RandomState(0).randint(0, 4096, (70, 50, 9)).astype(np.uint16)
+
+
+@pytest.fixture
+def cube(tmp_path, data):
+    path = str(tmp_path / "cube.hdf5")
+    with h5py.File(path, 'w') as hdf5:
+        hdf5.create_dataset("width", data=50, shape=())
+        hdf5.create_dataset("height", data=70, shape=())
+        hdf5.create_dataset("nSlices", data=9, shape=())
+        hdf5.create_dataset("bpc", data=12, shape=())
+        hdf5.create_dataset("data", data=data)
+    os.chmod(path, 0o644)
+    return path
+
+
+@pytest.mark.parametrize("chunks", [(16, 16, 0), (16, 16, 2)])
+def test_round_trip(cube, data, chunks):
+    assert migrate_hdf5(
+        cube, chunks=chunks, compression="gzip", shuffle=True,
+        projections=("min", "max", "average"), block_memory=16 * 16 * 4 * 2
+    )
+    with h5py.File(cube, 'r') as hdf5:
+        assert hdf5["data"].chunks == (16, 16, chunks[2] or 9)
+        assert hdf5["data"].compression == "gzip"
+        assert hdf5["bpc"][()] == 12
+        np.testing.assert_array_equal(hdf5["data"][()], data)
+        np.testing.assert_array_equal(hdf5["minProjection"][()], data.min(axis=-1))
+        np.testing.assert_array_equal(hdf5["maxProjection"][()], data.max(axis=-1))
+        np.testing.assert_array_equal(
+            hdf5["averageProjection"][()], data.mean(axis=-1).astype(data.dtype)
+        )
+
+
+def test_existing_datasets_are_kept(cube, data):
+    migrate_hdf5(cube, projections=("max",))
+    with h5py.File(cube, 'a') as hdf5:
+        hdf5.attrs["origin"] = "test"
+    migrate_hdf5(cube, compression="lzf")
+    with h5py.File(cube, 'r') as hdf5:
+        assert hdf5["data"].compression == "lzf"
+        assert hdf5.attrs["origin"] == "test"
+        np.testing.assert_array_equal(hdf5["maxProjection"][()], data.max(axis=-1))
+
+
+def test_skip_and_force(cube):
+    assert migrate_hdf5(cube, chunks=(16, 16, 0))
+    mtime = os.stat(cube).st_mtime_ns
+    assert not migrate_hdf5(cube, chunks=(16, 16, 0))
+    assert os.stat(cube).st_mtime_ns == mtime
+    assert migrate_hdf5(cube, chunks=(16, 16, 0), shuffle=True)
+    assert migrate_hdf5(cube, chunks=(16, 16, 0), shuffle=True, force=True)
+
+
+def test_file_mode_is_kept(cube):
+    os.chmod(cube, 0o640)
+    migrate_hdf5(cube)
+    assert os.stat(cube).st_mode & 0o777 == 0o640
+
+
+def test_checksum_failure(cube, data, monkeypatch):
+    monkeypatch.setattr(migrate, "_checksum", lambda dataset, block_memory: b"")
+    with pytest.raises(IOError):
+        migrate_hdf5(cube, chunks=(16, 16, 0))
+    assert os.listdir(os.path.dirname(cube)) == ["cube.hdf5"]
+    with h5py.File(cube, 'r') as hdf5:
+        assert hdf5["data"].chunks is None
+        np.testing.assert_array_equal(hdf5["data"][()], data)
+
+
+@pytest.mark.parametrize("chunks, block_memory", [
+    ((16, 16, 9), 16 * 16 * 9 * 2 * 3),
+    ((16, 16, 3), 16 * 16 * 3 * 2),
+    ((8, 8, 1), 100 * 8 * 8 * 2),
+])
+def test_blocks_cover_cube_within_memory(chunks, block_memory):
+    shape = (70, 50, 9)
+    covered = np.zeros(shape, dtype=int)
+    for bounds in iter_blocks(shape, chunks, 2, block_memory):
+        covered[bounds] += 1
+        block_bytes = np.prod(covered[bounds].shape) * 2
+        assert block_bytes <= max(block_memory, np.prod(chunks) * 2)
+    assert np.all(covered == 1)
+
+
+def test_main(cube, tmp_path):
+    assert main([str(tmp_path), "--workers", "1", "--projection", "min"]) == 0
+    with h5py.File(cube, 'r') as hdf5:
+        assert "minProjection" in hdf5
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2022. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+import h5py
+import numpy as np
+import pytest
+
+from cytomine_hms.reader import get_bin_starts, bin_profile, subsample_mask, \
+    extract_points, get_mean_spectrum, get_similarity_map
+
+
+@pytest.mark.parametrize("n_slices, bins, expected", [
+    (10, 6, [0, 2, 3, 5, 7, 8]),
+    (10, 1, [0]),
+    (3, 6, [0, 1, 2]),
+])
+def test_bin_starts_for_bins(n_slices, bins, expected):
+    np.testing.assert_array_equal(get_bin_starts(n_slices, bins=bins), expected)
+
+
+def test_bin_starts_for_bin_size():
+    np.testing.assert_array_equal(get_bin_starts(10, bin_size=3), [0, 3, 6, 9])
+
+
+def test_bin_profile():
+    profile = np.arange(20, dtype=np.uint16).reshape((2, 10))
+    starts = get_bin_starts(10, bin_size=3)
+    np.testing.assert_array_equal(
+        bin_profile(profile, starts), [[1, 4, 7, 9], [11, 14, 17, 19]]
+    )
+    np.testing.assert_array_equal(
+        bin_profile(profile, starts, 'max'), [[2, 5, 8, 9], [12, 15, 18, 19]]
+    )
+
+
+def test_subsample_mask_with_stride():
+    mask = np.zeros((40, 40), dtype=bool)
+    mask[5:25, 10:30] = True
+    sampled = subsample_mask(mask, stride=4)
+    assert np.count_nonzero(sampled) == 25
+    assert not np.any(sampled & ~mask)
+    np.testing.assert_array_equal(sampled.nonzero()[0][::5], np.arange(5, 25, 4))
+
+
+def test_subsample_mask_with_max_points():
+    mask = np.ones((100, 100), dtype=bool)
+    mask[0, 0] = False
+    sampled = subsample_mask(mask, max_points=50)
+    assert np.count_nonzero(sampled) == 50
+    assert not np.any(sampled & ~mask)
+    np.testing.assert_array_equal(sampled, subsample_mask(mask, max_points=50))
+
+
+def test_subsample_thin_line_missed_by_grid():
+    mask = np.zeros((60, 60), dtype=bool)
+    for k in range(40):
+        mask[6 + k, 45 - k] = True
+    sampled = subsample_mask(mask, stride=4)
+    assert 40 // 4 <= np.count_nonzero(sampled) <= 2 * 40 // 4
+    assert not np.any(sampled & ~mask)
+
+    sampled = subsample_mask(mask, stride=4, max_points=5)
+    assert np.count_nonzero(sampled) == 5
+    assert not np.any(sampled & ~mask)
+
+
+def test_subsample_line_sparsely_hit_by_grid():
+    mask = np.zeros((60, 60), dtype=bool)
+    for k in range(48):
+        mask[k, (5 * k) // 6] = True
+    sampled = subsample_mask(mask, stride=4)
+    assert not np.any(sampled & ~mask)
+    assert np.count_nonzero(sampled) >= 48 // 4
+
+
+@pytest.fixture
+def cube(tmp_path):
+    data = np.random.RandomState(0).randint(0, 1000, (30, 20, 8)).astype(np.uint16)
+    with h5py.File(str(tmp_path / "cube.hdf5"), 'w') as hdf5:
+        hdf5.create_dataset("data", data=data)
+    with h5py.File(str(tmp_path / "cube.hdf5"), 'r') as hdf5:
+        yield hdf5, data
+
+
+def region_mask(shape=(30, 20)):
+    mask = np.zeros(shape, dtype=bool)
+    mask[3:27, 2:19] = True
+    mask[3, 2] = False
+    return mask
+
+
+def expected_similarity(block, reference, metric):
+    block = block.astype(np.float64)
+    if metric == 'euclidean':
+        return np.sqrt(np.sum((block - reference) ** 2, axis=-1))
+    cosine = block @ reference / (np.linalg.norm(block, axis=-1) * np.linalg.norm(reference))
+    return cosine if metric == 'cosine' else np.arccos(np.clip(cosine, -1, 1))
+
+
+@pytest.mark.parametrize("metric", ['cosine', 'angle', 'euclidean'])
+@pytest.mark.parametrize("block_memory", [64 * 2 ** 20, 6 * 4 * 7, 6 * 4 * 40])
+def test_similarity_map(cube, metric, block_memory):
+    hdf5, data = cube
+    mask = region_mask()
+    reference = np.arange(1, 7, dtype=np.float64) * 50
+    similarity = get_similarity_map(hdf5, mask, (1, 7), reference, metric, block_memory)
+
+    expected = expected_similarity(data[3:27, 2:19, 1:7], reference, metric)
+    assert similarity.shape == (24, 17)
+    assert similarity.dtype == np.float32
+    np.testing.assert_allclose(similarity, expected, rtol=1e-4, atol=1e-3)
+
+
+def test_similarity_of_reference_pixel(cube):
+    hdf5, data = cube
+    mask = region_mask()
+    similarity = get_similarity_map(hdf5, mask, (0, 8), data[10, 5], 'euclidean')
+    assert similarity[10 - 3, 5 - 2] == 0
+
+
+def test_mean_spectrum(cube):
+    hdf5, data = cube
+    mask = region_mask()
+    np.testing.assert_allclose(
+        get_mean_spectrum(hdf5, mask, (2, 6)), data[mask][:, 2:6].mean(axis=0)
+    )
+
+
+def test_extract_points(cube):
+    hdf5, data = cube
+    mask = subsample_mask(region_mask(), stride=5)
+    profile = extract_points(hdf5, mask, (2, 6))
+    np.testing.assert_array_equal(profile, data[mask][:, 2:6])
+    assert extract_points(hdf5, np.zeros_like(mask), (2, 6)).shape == (0, 4)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2022. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from cytomine_hms.shards import ShardTable, LeaseHeartbeat, get_part_path, \
+    get_shard_bounds, assemble_virtual_dataset, remove_parts, DONE, FAILED
+
+
+@pytest.fixture
+def table(tmp_path):
+    table = ShardTable(str(tmp_path / "cube.hdf5.shards.sqlite"))
+    assert table.initialize(5, 3, 2)
+    return table
+
+
+def test_initialize_splits_tile_grid(table):
+    shards = table.shards()
+    assert len(shards) == 6
+    assert (shards[-1]['min_x'], shards[-1]['max_x']) == (4, 5)
+    assert (shards[-1]['min_y'], shards[-1]['max_y']) == (2, 3)
+    assert not table.initialize(5, 3, 2)
+
+
+def test_expired_lease_is_taken_over(table):
+    shards = [table.acquire("dead", 0.2) for _ in range(6)]
+    assert table.acquire("alive", 10) is None
+    assert table.is_running()
+
+    time.sleep(0.3)
+    shard = table.acquire("alive", 10)
+    assert shard['id'] == shards[0]['id']
+    assert not table.complete(shard['id'], "dead")
+    assert table.complete(shard['id'], "alive")
+
+
+def test_finalization(table):
+    for _ in range(6):
+        shard = table.acquire("worker", 10)
+        assert not table.claim_finalization("worker")
+        table.complete(shard['id'], "worker")
+
+    assert not table.is_running()
+    assert table.claim_finalization("worker")
+    assert not table.claim_finalization("other")
+
+
+def test_failure_then_new_conversion(table):
+    shard = table.acquire("worker", 10)
+    other = table.acquire("other", 10)
+    table.fail(shard['id'], "worker")
+
+    assert table.acquire("worker", 10) is None
+    assert not table.is_running()
+    assert table.claim_finalization("worker")
+    assert not table.complete(other['id'], "other")
+
+    # Neither a plain join nor a reset restarts it while the finalizer runs.
+    assert not table.initialize(5, 3, 2)
+    assert not table.initialize(5, 3, 2, reset=True, stale_after=60)
+    table.finish("other")
+    assert not table.initialize(5, 3, 2, reset=True)
+
+    table.finish("worker")
+    assert not table.initialize(5, 3, 2)
+    assert table.initialize(5, 3, 2, reset=True)
+    assert table.counts() == {'pending': 6}
+
+
+def test_reset_after_dead_finalizer(table):
+    for _ in range(6):
+        shard = table.acquire("worker", 10)
+        table.complete(shard['id'], "worker")
+    assert table.claim_finalization("worker")
+
+    assert not table.initialize(5, 3, 2, reset=True, stale_after=60)
+    time.sleep(0.2)
+    assert table.initialize(5, 3, 2, reset=True, stale_after=0.1)
+
+
+def test_heartbeat_renews_lease(table):
+    shard = table.acquire("worker", 0.3)
+    heartbeat = LeaseHeartbeat(table, shard['id'], "worker", 0.3)
+    heartbeat.start()
+    time.sleep(0.6)
+    assert table.acquire("other", 10)['id'] != shard['id']
+    heartbeat.stop()
+    assert table.complete(shard['id'], "worker")
+
+
+def test_assemble_virtual_dataset(tmp_path, table):
+    path = str(tmp_path / "cube.hdf5")
+    tile_size = 4
+    data = np.arange(10 * 18 * 2, dtype=np.uint16).reshape((10, 18, 2))
+    shards = table.shards()
+    for shard in shards:
+        rows, cols = get_shard_bounds(shard, tile_size, 10, 18)
+        with h5py.File(get_part_path(path, shard['id']), 'w') as part:
+            part.create_dataset("data", data=data[rows, cols])
+        table.acquire("worker", 10)
+        table.complete(shard['id'], "worker")
+    assert table.counts() == {DONE: 6}
+
+    scalars = {"width": 18, "height": 10, "nSlices": 2, "bpc": 16}
+    assemble_virtual_dataset(path, shards, tile_size, scalars, data.shape, data.dtype)
+    with h5py.File(path, 'r') as hdf5:
+        assert hdf5['data'].is_virtual
+        assert hdf5['width'][()] == 18
+        np.testing.assert_array_equal(hdf5['data'][()], data)
+
+    (tmp_path / "cube.hdf5.part00001.abc.tmp").write_bytes(b"")
+    remove_parts(path, tmp_only=True)
+    assert not (tmp_path / "cube.hdf5.part00001.abc.tmp").exists()
+    assert (tmp_path / "cube.hdf5.part00001").exists()
+    remove_parts(path)
+    assert not list(tmp_path.glob("cube.hdf5.part*"))
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2022. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from threading import Thread, Lock
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+import pytest
+from PIL import Image
+from cytomine.models import UploadedFile
+
+from cytomine_hms.shards import get_part_path
+from cytomine_hms.writer import get_tile, get_accept_header, parse_tile_formats, \
+    create_hdf5_sharded, TILE_FORMATS
+
+TILE_SIZE = 16
+IMAGE = SimpleNamespace(width=40, height=24)
+
+
+def full_image(channel=0):
+    return np.arange(IMAGE.height * IMAGE.width).reshape((IMAGE.height, IMAGE.width)) \
+        + 1000 * channel
+
+
+class ImageServer(ThreadingHTTPServer):
+    """
+    Local image server stand-in answering window requests with a gradient
+    image in the first format of `supported` accepted by the client.
+    Each channel is offset by 1000.
+    """
+    supported = ('raw', 'tiff', 'png')
+    raw_dtype = None
+    raw_shape = None
+    truncate = False
+    fail = False
+
+
+class WindowHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        parameters = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if server.fail:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        region = parameters['region']
+        dtype = np.uint16 if parameters['bits'] > 8 else np.uint8
+        tile = (
+            full_image(parameters['channels'])
+            [region['top']:region['top'] + region['height'],
+             region['left']:region['left'] + region['width']]
+        ).astype(dtype)
+        server.last_accept = self.headers['Accept']
+
+        accepted = [m.split(';')[0].strip() for m in self.headers['Accept'].split(',')]
+        fmt = next(
+            f for f in server.supported if TILE_FORMATS[f] in accepted
+        )
+        headers = {'Content-Type': TILE_FORMATS[fmt]}
+        if fmt == 'raw':
+            raw_dtype = np.dtype(server.raw_dtype or tile.dtype.newbyteorder('<'))
+            body = tile.astype(raw_dtype).tobytes()
+            shape = server.raw_shape or tile.shape
+            headers['X-Array-Shape'] = ",".join(map(str, shape))
+            headers['X-Array-Dtype'] = raw_dtype.str
+            if server.truncate:
+                body = body[:len(body) // 2]
+        else:
+            img_io = BytesIO()
+            Image.fromarray(tile).save(img_io, 'tiff' if fmt == 'tiff' else 'png')
+            body = img_io.getvalue()
+
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = ImageServer(('127.0.0.1', 0), WindowHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(server, x=1, y=1, bpc=16, formats=('raw', 'tiff', 'png')):
+    _slice = SimpleNamespace(
+        imageServerUrl="http://127.0.0.1:{}".format(server.server_address[1]),
+        path="image", channel=0, zStack=0, time=0
+    )
+    tile_info = {"X": x, "Y": y, "slice": _slice}
+    return get_tile(tile_info, IMAGE, bpc, TILE_SIZE, formats)
+
+
+def expected_tile(x, y, dtype):
+    full = full_image()
+    return full[y * TILE_SIZE:(y + 1) * TILE_SIZE, x * TILE_SIZE:(x + 1) * TILE_SIZE].astype(dtype)
+
+
+def test_accept_header():
+    assert get_accept_header(('raw', 'png')) == \
+        "application/octet-stream;q=1.0, image/png;q=0.9"
+
+
+def test_parse_tile_formats():
+    assert parse_tile_formats(" RAW, png ") == ('raw', 'png')
+    with pytest.raises(ValueError):
+        parse_tile_formats("raw,jpeg")
+    with pytest.raises(ValueError):
+        parse_tile_formats("")
+
+
+@pytest.mark.parametrize("bpc, dtype", [(16, np.uint16), (8, np.uint8)])
+def test_raw_tile(server, bpc, dtype):
+    tile = fetch(server, x=2, y=1, bpc=bpc)
+    assert tile.shape == (8, 8)
+    assert tile.dtype == dtype
+    np.testing.assert_array_equal(tile, expected_tile(2, 1, dtype))
+    assert server.last_accept.startswith("application/octet-stream;q=1.0")
+
+
+@pytest.mark.parametrize("supported", [('tiff',), ('png',)])
+def test_fallback_formats(server, supported):
+    server.supported = supported
+    tile = fetch(server)
+    np.testing.assert_array_equal(tile, expected_tile(1, 1, np.uint16))
+
+
+def test_format_preference(server):
+    server.supported = ('raw', 'png')
+    tile = fetch(server, formats=('png',))
+    assert server.last_accept == "image/png;q=1.0"
+    np.testing.assert_array_equal(tile, expected_tile(1, 1, np.uint16))
+
+
+def test_truncated_raw_tile(server):
+    server.truncate = True
+    with pytest.raises(IOError):
+        fetch(server)
+
+
+def test_raw_tile_with_wrong_shape(server):
+    server.raw_shape = (16, 8)
+    with pytest.raises(ValueError):
+        fetch(server)
+
+
+@pytest.mark.parametrize("raw_dtype", [">u2", "<u4", "u1"])
+def test_raw_tile_with_wrong_type(server, raw_dtype):
+    server.raw_dtype = raw_dtype
+    with pytest.raises(ValueError):
+        fetch(server)
+
+
+class FakeModel(SimpleNamespace):
+    """
+    Stand-in for Cytomine models shared by several workers: `fetch` and
+    `update` go through a common store, and status updates are recorded.
+    """
+    ERROR_CONVERSION = UploadedFile.ERROR_CONVERSION
+    CONVERTED = UploadedFile.CONVERTED
+
+    def __init__(self, store, **attributes):
+        super().__init__(store=store, **attributes)
+
+    def fetch(self):
+        return FakeModel(self.store, **self.store['attributes'])
+
+    def update(self):
+        with self.store['lock']:
+            attributes = {k: v for k, v in vars(self).items() if k != 'store'}
+            if attributes.get('status') != self.store['attributes'].get('status'):
+                self.store['history'].append(attributes.get('status'))
+            self.store['attributes'] = attributes
+        return self
+
+
+@pytest.fixture
+def conversion(server, tmp_path):
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+    image = SimpleNamespace(
+        originalFilename="image", width=IMAGE.width, height=IMAGE.height,
+        channels=3, depth=1, duration=1, bitPerSample=16
+    )
+    slices = [
+        SimpleNamespace(
+            imageServerUrl=url, path="image", rank=c, channel=c, zStack=0, time=0
+        ) for c in range(3)
+    ]
+    uploaded_file_store = dict(
+        lock=Lock(), history=[], attributes=dict(path="cube.hdf5", status=None)
+    )
+    cf_store = dict(lock=Lock(), history=[], attributes=dict(progress=0))
+
+    def convert(reconvert=False):
+        create_hdf5_sharded(
+            FakeModel(uploaded_file_store).fetch(), image, slices,
+            FakeModel(cf_store).fetch(), n_workers=2, tile_size=TILE_SIZE,
+            root=str(tmp_path), shard_size=1, lease_duration=30,
+            poll_interval=0.1, reconvert=reconvert
+        )
+
+    def convert_concurrently(n, **kwargs):
+        threads = [Thread(target=convert, kwargs=kwargs) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return SimpleNamespace(
+        path=str(tmp_path / "cube.hdf5"), history=uploaded_file_store['history'],
+        convert=convert, convert_concurrently=convert_concurrently
+    )
+
+
+def assert_converted(path):
+    expected = np.stack([full_image(c) for c in range(3)], axis=-1)
+    with h5py.File(path, 'r') as hdf5:
+        assert hdf5['data'].is_virtual
+        assert hdf5['nSlices'][()] == 3
+        np.testing.assert_array_equal(hdf5['data'][()], expected)
+
+
+def part_mtimes(path):
+    return {i: os.stat(get_part_path(path, i)).st_mtime_ns for i in range(1, 7)}
+
+
+def test_sharded_conversion(conversion):
+    conversion.convert_concurrently(3)
+    assert conversion.history == [UploadedFile.CONVERTING, UploadedFile.CONVERTED]
+    assert_converted(conversion.path)
+    assert not [f for f in os.listdir(os.path.dirname(conversion.path)) if f.endswith(".tmp")]
+
+
+def test_late_join_does_not_restart(conversion):
+    conversion.convert_concurrently(3)
+    mtimes = part_mtimes(conversion.path)
+
+    conversion.convert()
+    assert conversion.history == [UploadedFile.CONVERTING, UploadedFile.CONVERTED]
+    assert part_mtimes(conversion.path) == mtimes
+    assert_converted(conversion.path)
+
+
+def test_reconvert(conversion):
+    conversion.convert()
+    mtimes = part_mtimes(conversion.path)
+
+    conversion.convert_concurrently(2, reconvert=True)
+    assert conversion.history == [UploadedFile.CONVERTING, UploadedFile.CONVERTED] * 2
+    assert all(a != b for a, b in zip(part_mtimes(conversion.path).values(), mtimes.values()))
+    assert_converted(conversion.path)
+
+
+def test_failed_conversion_then_reconvert(conversion, server):
+    server.fail = True
+    conversion.convert_concurrently(2)
+    assert conversion.history == [UploadedFile.CONVERTING, UploadedFile.ERROR_CONVERSION]
+    assert not os.path.exists(conversion.path)
+    assert not [f for f in os.listdir(os.path.dirname(conversion.path)) if ".part" in f]
+
+    server.fail = False
+    conversion.convert()
+    assert len(conversion.history) == 2
+
+    conversion.convert(reconvert=True)
+    assert conversion.history[-1] == UploadedFile.CONVERTED
+    assert_converted(conversion.path)